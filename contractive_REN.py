@@ -2,6 +2,111 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from collections import OrderedDict
+from typing import Tuple
+
+
+@torch.jit.script
+def solve_w(v: torch.Tensor, H22: torch.Tensor, Lambda: torch.Tensor) -> torch.Tensor:
+    """
+    Solves the implicit equation of the nonlinear block, w = tanh(Λ^-1 (C_1 x + D_11 w + D_12 u)),
+    by forward substitution over the rows of the strictly lower triangular D_11 = -tril(H_22, -1).
+
+    Args:
+        v (torch.Tensor): C_1 x + D_12 u, constant across the rows, with the size of (batch_size, dim_nl).
+        H22 (torch.Tensor): Block of H whose strictly lower triangular part gives -D_11, with the size of (dim_nl, dim_nl).
+        Lambda (torch.Tensor): Diagonal of Λ with the size of (dim_nl,).
+
+    Return:
+        w (torch.Tensor): Output of the nonlinear block with the size of (batch_size, dim_nl).
+    """
+    w = []
+    # once w_i is known, its contribution -H22[i + 1:, i] * w_i is added to the rows below i,
+    # which are the only ones left in v
+    for i in range(H22.shape[0]):
+        w_i = torch.tanh(v[..., 0] / Lambda[i])
+        v = v[..., 1:] - H22[i + 1:, i] * w_i.unsqueeze(-1)
+        w.append(w_i)
+    return torch.stack(w, dim=-1)
+
+
+@torch.jit.script
+def derive_params(
+    X: torch.Tensor, Y: torch.Tensor, eye_mask_H: torch.Tensor, epsilon: float, contraction_rate_lb: float,
+    dim_internal: int, dim_nl: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Derives the non-trainable matrices of the REN from the trainable X and Y, so that the model is contractive.
+
+    Args:
+        X (torch.Tensor): Trainable matrix with the size of (2 * dim_internal + dim_nl, 2 * dim_internal + dim_nl).
+        Y (torch.Tensor): Trainable matrix with the size of (dim_internal, dim_internal).
+        eye_mask_H (torch.Tensor): Identity matrix with the size of X.
+        epsilon (float): Positive and negligible scalar to force positive definite matrices.
+        contraction_rate_lb (float): Lower bound on the contraction rate.
+        dim_internal (int): Internal state (x) dimension.
+        dim_nl (int): Dimension of the input ("v") and ouput ("w") of the nonlinear static block.
+
+    Return:
+        F, B1, E, Lambda, H22, C1 (torch.Tensor): Derived matrices, with D11 = -tril(H22, diagonal=-1)
+            and Lambda the diagonal of Λ.
+    """
+    # dependent params
+    H = torch.matmul(X.T, X) + epsilon * eye_mask_H
+    sizes = [dim_internal, dim_nl, dim_internal]
+    h1, h2, h3 = torch.split(H, sizes, dim=0)
+    H11, _, _ = torch.split(h1, sizes, dim=1)
+    H21, H22, _ = torch.split(h2, sizes, dim=1)
+    H31, H32, H33 = torch.split(h3, sizes, dim=1)
+    P = H33
+
+    # nn state dynamics
+    F_ = H31
+    B1 = H32
+
+    # nn output
+    E = 0.5 * (H11 + contraction_rate_lb * P + Y - Y.T)
+
+    # v signal for strictly acyclic REN
+    Lambda = 0.5 * torch.diagonal(H22)
+    C1 = -H21
+    return F_, B1, E, Lambda, H22, C1
+
+
+@torch.jit.script
+def ren_step(
+    x: torch.Tensor, u_proj: torch.Tensor, C1: torch.Tensor, H22: torch.Tensor, Lambda: torch.Tensor,
+    F_: torch.Tensor, B1: torch.Tensor, C2: torch.Tensor, D21: torch.Tensor, E_LU: torch.Tensor, E_pivots: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    One step of REN, given the non-trainable model params.
+
+    Args:
+        x (torch.Tensor): Internal state with the size of (batch_size, dim_internal).
+        u_proj (torch.Tensor): Contributions of the input [D_12 u, B_2 u, D_22 u] with the size of
+            (batch_size, dim_nl + dim_internal + dim_out).
+        C1, H22, Lambda (torch.Tensor): Matrices of the nonlinear block, see solve_w.
+        F_, B1, C2, D21 (torch.Tensor): Matrices of the state and output updates.
+        E_LU, E_pivots (torch.Tensor): LU factorization of E.
+
+    Return:
+        x_next (torch.Tensor): Next internal state with the size of (batch_size, dim_internal).
+        y_out (torch.Tensor): Output with the size of (batch_size, dim_out).
+    """
+    # all tensors are 2D (batch_size, dim), so that each matmul and its accumulation is a single addmm
+    Du, Bu, DDu = torch.split(u_proj, [H22.shape[0], F_.shape[0], C2.shape[0]], dim=-1)
+
+    # update each row of w using Eq. (8) with a strictly lower triangular D11,
+    # the part of v that does not depend on w is computed once for all rows
+    w = solve_w(torch.addmm(Du, x, C1.T), H22, Lambda)
+
+    # compute next state using Eq. 18, i.e., solve x_t+1 E^T = x_t F^T + w_t B_1^T + u_t B_2^T
+    rhs = torch.addmm(torch.addmm(Bu, x, F_.T), w, B1.T)
+    # under autocast, rhs may be in a lower precision than the LU factors
+    x_next = torch.linalg.lu_solve(E_LU, E_pivots, rhs.to(E_LU.dtype), left=False, adjoint=True)
+
+    # compute output
+    y_out = torch.addmm(torch.addmm(DDu, x_next, C2.T), w, D21.T)
+    return x_next, y_out
 
 
 class ContractiveREN(nn.Module):
@@ -29,7 +134,8 @@ class ContractiveREN(nn.Module):
     def __init__(
         self, dim_in: int, dim_out: int, dim_internal: int,
         dim_nl: int, internal_state_init = None, y_init = None,
-        initialization_std: float = 0.5, pos_def_tol: float = 0.001, contraction_rate_lb: float = 1.0
+        initialization_std: float = 0.5, pos_def_tol: float = 0.001, contraction_rate_lb: float = 1.0,
+        compile_run: bool = False
     ):
         """
         Args:
@@ -41,6 +147,7 @@ class ContractiveREN(nn.Module):
             internal_state_init (torch.Tensor or None, optional): Initial condition for the internal state. Defaults to 0 when set to None.
             epsilon (float, optional): Positive and negligible scalar to force positive definite matrices.
             contraction_rate_lb (float, optional): Lower bound on the contraction rate. Defaults to 1.
+            compile_run (bool, optional): Compile the rollout in run() with torch.compile, once per horizon. Defaults to False.
         """
         super().__init__()
 
@@ -75,78 +182,139 @@ class ContractiveREN(nn.Module):
 
         # mask
         self.register_buffer('eye_mask_H', torch.eye(2 * self.dim_internal + self.dim_nl))
-        self.register_buffer('eye_mask_w', torch.eye(self.dim_nl))
 
         # initialize internal state
         if internal_state_init is None:
             if y_init is None:
-                self.x = torch.zeros(1, 1, self.dim_internal)
+                x_init = torch.zeros(1, 1, self.dim_internal)
             else:
-                y_init = y_init.reshape(1, -1)
-                self.x = torch.linalg.lstsq(self.C2, y_init.to(self.C2.device).squeeze(1).T)[0].T
+                x_init = self._init_state_from_y(y_init)
         else:
             assert isinstance(internal_state_init, torch.Tensor)
-            self.x = internal_state_init.reshape(1, 1, self.dim_internal)
-        self.register_buffer('x_init', self.x.detach().clone())
-        self.register_buffer('y_init', F.linear(self.x_init, self.C2))
+            x_init = internal_state_init.reshape(1, 1, self.dim_internal)
+        self.register_buffer('x_init', x_init.detach().clone())
+        self.register_buffer('y_init', F.linear(self.x_init, self.C2).detach())
+
+        # caching of the non-trainable model params in evaluation mode, see _update_model_param()
+        self._eval_params_cached = False
+        # set by reset() and cleared by end_rollout(), see forward()
+        self._in_rollout = False
+        self._update_model_param()
 
-    def _update_model_param(self):
-        """
-        Update non-trainable matrices according to the REN formulation to preserve contraction.
-        """
-        # dependent params
-        H = torch.matmul(self.X.T, self.X) + self.epsilon * self.eye_mask_H
-        h1, h2, h3 = torch.split(H, [self.dim_internal, self.dim_nl, self.dim_internal], dim=0)
-        H11, H12, H13 = torch.split(h1, [self.dim_internal, self.dim_nl, self.dim_internal], dim=1)
-        H21, H22, _ = torch.split(h2, [self.dim_internal, self.dim_nl, self.dim_internal], dim=1)
-        H31, H32, H33 = torch.split(h3, [self.dim_internal, self.dim_nl, self.dim_internal], dim=1)
-        P = H33
+        # compiled rollout. The loop over the horizon is unrolled, so each new horizon compiles once;
+        # beyond torch._dynamo.config.cache_size_limit horizons, the rollout falls back to eager
+        if compile_run:
+            self._run_compiled = torch.compile(self._run_impl, mode="reduce-overhead")
+        else:
+            self._run_compiled = None
 
-        # nn state dynamics
-        self.F = H31
-        self.B1 = H32
+    def _init_state_from_y(self, y_init):
+        """
+        Initial state whose output C_2 x is y_init, i.e., the least-squares solution of minimum norm.
 
-        # nn output
-        self.E = 0.5 * (H11 + self.contraction_rate_lb * P + self.Y - self.Y.T)
-        self.E_inv = self.E.inverse()
+        Args:
+            y_init (torch.Tensor): Initial output with dim_out elements.
 
-        # v signal for strictly acyclic REN
-        self.Lambda = 0.5 * torch.diag(H22)
-        self.D11 = -torch.tril(H22, diagonal=-1)
-        self.C1 = -H21
+        Return:
+            x_init (torch.Tensor): Initial state with the size of (1, 1, self.dim_internal).
+        """
+        with torch.no_grad():
+            y_init = y_init.to(device=self.C2.device, dtype=self.C2.dtype).reshape(-1, 1)
+            return (torch.linalg.pinv(self.C2) @ y_init).T.unsqueeze(0)
 
-    def forward(self, u_in):
+    def _update_model_param(self):
+        """
+        Update non-trainable matrices according to the REN formulation to preserve contraction.
+        In evaluation mode under torch.no_grad(), they are updated once without autograd graph
+        and reused until train(), eval(), to() or load_state_dict() is called.
         """
-        Forward pass of REN.
+        eval_cache = not self.training and not torch.is_grad_enabled()
+        if eval_cache and self._eval_params_cached:
+            return
+
+        # TorchScript functions record the autograd graph even under torch.no_grad(),
+        # so the trainable params are detached when no graph is needed
+        requires_grad = torch.is_grad_enabled()
+        X, Y = (self.X, self.Y) if requires_grad else (self.X.detach(), self.Y.detach())
+
+        # derive the matrices in the precision of the trainable params even under autocast,
+        # since E is factorized and Lambda divides the nonlinear block
+        with torch.autocast(device_type=self.X.device.type, enabled=False):
+            self.F, self.B1, self.E, self.Lambda, self.H22, self.C1 = derive_params(
+                X, Y, self.eye_mask_H, self.epsilon, self.contraction_rate_lb, self.dim_internal, self.dim_nl
+            )
+            # LU factorization of E, used to solve for the next state instead of forming E^-1
+            self.E_LU, self.E_pivots = torch.linalg.lu_factor(self.E)
+
+            # stacked matrices acting on u, see ren_step
+            self.DBD = torch.cat([self.D12, self.B2, self.D22], dim=0)
+
+        self._eval_params_cached = eval_cache
+
+    # drop the matrices cached in evaluation mode whenever the trainable params may have changed
+    def train(self, mode: bool = True):
+        self._eval_params_cached = False
+        return super().train(mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._eval_params_cached = False
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._eval_params_cached = False
+        # older checkpoints store the unused eye_mask_w, and x_init and y_init without the time
+        # dimension when the REN was built from y_init
+        state_dict.pop(prefix + 'eye_mask_w', None)
+        for name in ('x_init', 'y_init'):
+            key = prefix + name
+            buffer = getattr(self, name)
+            if key in state_dict and state_dict[key].shape != buffer.shape and state_dict[key].numel() == buffer.numel():
+                state_dict[key] = state_dict[key].reshape(buffer.shape)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, u_in):
+        """
+        Forward pass of REN. The non-trainable model params are updated at every step, unless a rollout
+        was started by reset() and not yet ended by end_rollout(), in which case they are reused.
 
         Args:
+            x (torch.Tensor): Internal state with the size of (batch_size, 1, self.dim_internal).
+                At the first step of a rollout, this is self.x_init.
             u_in (torch.Tensor): Input with the size of (batch_size, 1, self.dim_in).
 
         Return:
+            x_next (torch.Tensor): Next internal state with (batch_size, 1, self.dim_internal).
             y_out (torch.Tensor): Output with (batch_size, 1, self.dim_out).
         """
-        # update non-trainable model params
-        self._update_model_param()
-
-        batch_size = u_in.shape[0]
-
-        w = torch.zeros(batch_size, 1, self.dim_nl, device=u_in.device)
-
-        # update each row of w using Eq. (8) with a lower triangular D11
-        for i in range(self.dim_nl):
-            #  v is element i of v with dim (batch_size, 1)
-            v = F.linear(self.x, self.C1[i, :]) + F.linear(w, self.D11[i, :]) + F.linear(u_in, self.D12[i,:])
-            w = w + (self.eye_mask_w[i, :] * torch.tanh(v / self.Lambda[i])).reshape(batch_size, 1, self.dim_nl)
-
-        # compute next state using Eq. 18
-        self.x = F.linear(F.linear(self.x, self.F) + F.linear(w, self.B1) + F.linear(u_in, self.B2), self.E_inv)
-
-        # compute output
-        y_out = F.linear(self.x, self.C2) + F.linear(w, self.D21) + F.linear(u_in, self.D22)
-        return y_out
+        if not self._in_rollout:
+            self._update_model_param()
+
+        # the step works on 2D tensors, the time dimension is only restored here
+        u_in = u_in.squeeze(1)
+        x = x.reshape(-1, self.dim_internal).expand(u_in.shape[0], self.dim_internal)
+        x_next, y_out = self._step(x, F.linear(u_in, self.DBD))
+        return x_next.unsqueeze(1), y_out.unsqueeze(1)
+
+    def _step(self, x, u_proj):
+        # REN step on 2D tensors, with the contributions of the input already computed
+        return ren_step(
+            x, u_proj, self.C1, self.H22, self.Lambda, self.F, self.B1, self.C2, self.D21, self.E_LU, self.E_pivots
+        )
 
     def reset(self):
-        self.x = self.x_init  # reset the REN state to the initial value
+        """
+        Starts a rollout of forward() steps, which starts from the state self.x_init, by updating the
+        non-trainable model params. These are reused by forward() until end_rollout(), so do not
+        update the trainable params in between.
+        """
+        self._update_model_param()
+        self._in_rollout = True
+
+    def end_rollout(self):
+        """
+        Ends the rollout started by reset(): forward() updates the non-trainable model params again.
+        """
+        self._in_rollout = False
 
 
     def run(self, u_in):
@@ -159,11 +327,23 @@ class ContractiveREN(nn.Module):
         Return:
             y_out (torch.Tensor): Output with (batch_size, horizon, self.dim_out).
         """
+        if self._run_compiled is not None:
+            return self._run_compiled(u_in)
+        return self._run_impl(u_in)
+
+    def _run_impl(self, u_in):
+        # the steps below do not go through forward(), so no rollout is started
+        self._update_model_param()
 
-        self.reset()
-        y_log = self.y_init.detach().clone().repeat(u_in.shape[0], 1, 1)
-        for t in range(u_in.shape[1] - 1):
-            y_log = torch.cat((y_log, self.forward(u_in[:, t:t + 1, :])), 1)
+        batch_size, horizon = u_in.shape[0], u_in.shape[1]
+        y_log = u_in.new_empty(batch_size, horizon, self.dim_out)
+        y_log[:, 0:1] = self.y_init.expand(batch_size, 1, -1)
+        x = self.x_init.reshape(1, self.dim_internal).expand(batch_size, self.dim_internal).contiguous()
+        # the whole input sequence is known: compute its contributions with one matmul and
+        # hand each step a (batch_size, dim) view of it, instead of concatenating u into the state at every step
+        u_proj = F.linear(u_in, self.DBD)
+        for t in range(horizon - 1):
+            x, y_log[:, t + 1] = self._step(x, u_proj[:, t])
         # note that the last input is not used
         return y_log
 
@@ -133,16 +133,19 @@ class ClosedLoopSystem(nn.Module):
         else:
             self.system_model_tipe = "REN"
 
-    def forward(self, y, u_ext):
+    def forward(self, y, u_ext, x_ren=None):
         """
         Compute the next state and output of the system.
 
         Args:
             u_ext (torch.Tensor): external input at t. shape = (batch_size, 1, input_dim)
             y (torch.Tensor): plant's output at t. shape = (batch_size, 1, output_dim)
+            x_ren (torch.Tensor, optional): internal state of the REN at t, only used when the system is a REN.
+                Defaults to its initial state. shape = (batch_size, 1, dim_internal)
 
         Returns:
             torch.Tensor, torch.Tensor: Input of plant and next output at t+1. shape = (batch_size, 1, state_dim), shape = (batch_size, 1, output_dim)
+            When the system is a REN, its internal state at t+1 is returned as well. shape = (batch_size, 1, dim_internal)
         """
 
         #Compute next state and output
@@ -152,10 +155,13 @@ class ClosedLoopSystem(nn.Module):
         if self.system_model_tipe == "real_sys":
             x, y = self.system_model.forward(x, u)
         elif self.system_model_tipe == "REN":
-            y = self.system_model.forward(u)
+            if x_ren is None:
+                x_ren = self.system_model.x_init
+            x_ren, y = self.system_model.forward(x_ren, u)
+            return u, y, x_ren
         return u, y
 
-    def noisy_forward(self, y, u_ext, output_noise_std):
+    def noisy_forward(self, y, u_ext, output_noise_std, x_ren=None):
         """
         Compute the next state and output of the system.
 
@@ -163,17 +169,24 @@ class ClosedLoopSystem(nn.Module):
             u_ext (torch.Tensor): external input at t. shape = (batch_size, 1, input_dim)
             y (torch.Tensor): plant's output at t. shape = (batch_size, 1, output_dim)
             output_noise_std: standard deviation of output noise
+            x_ren (torch.Tensor, optional): internal state of the REN at t, see forward.
 
         Returns:
             torch.Tensor, torch.Tensor: Input of plant and next output at t+1. shape = (batch_size, 1, state_dim), shape = (batch_size, 1, output_dim)
+            When the system is a REN, its internal state at t+1 is returned as well, see forward.
         """
 
-        u, y = self.forward(y, u_ext)
+        if self.system_model_tipe == "REN":
+            u, y, x_ren = self.forward(y, u_ext, x_ren)
+        else:
+            u, y = self.forward(y, u_ext)
 
         # Add Gaussian additive noise
         noise = torch.randn_like(y) * output_noise_std
         y_noisy = y + noise
 
+        if self.system_model_tipe == "REN":
+            return u, y_noisy, x_ren
         return u, y_noisy
 
 
@@ -234,24 +247,28 @@ class ClosedLoopSystem(nn.Module):
             input_dim = self.system_model.dim_in
 
             self.system_model.reset()
-            y = self.system_model.y_init.detach().clone().repeat(batch_size, 1, 1)
+            x_ren = self.system_model.x_init  # internal state of the REN
+            y = self.system_model.y_init.expand(batch_size, 1, -1)
 
             # Storage for trajectories
             y_traj = []
             u_traj = []
 
-            for t in range(horizon):
-                control_u = self.controller.forward(y)  # Compute control input
-
-                #minus sign for the control input
-                if self.negative:
-                    control_u = -control_u
-                u = control_u + u_ext[:, t:t + 1, :]
-
-                y = y + torch.randn_like(y) * output_noise_std
-                y_traj.append(y)  # Store output
-                u_traj.append(u)  # Store input
-                y = self.system_model.forward(u)  # Apply input to REN
+            try:
+                for t in range(horizon):
+                    control_u = self.controller.forward(y)  # Compute control input
+
+                    #minus sign for the control input
+                    if self.negative:
+                        control_u = -control_u
+                    u = control_u + u_ext[:, t:t + 1, :]
+
+                    y = y + torch.randn_like(y) * output_noise_std
+                    y_traj.append(y)  # Store output
+                    u_traj.append(u)  # Store input
+                    x_ren, y = self.system_model.forward(x_ren, u)  # Apply input to REN
+            finally:
+                self.system_model.end_rollout()
 
 
             # Convert lists to tensors